@@ -1,23 +1,44 @@
 # backend/app/main.py
 
 import os
-import shutil
-from typing import List, Tuple # Import List and Tuple for type hinting
+import json
+import time
+import asyncio
+import logging
+import contextvars
+import uuid
+import anyio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Iterator, List, Optional, Tuple # Import List and Tuple for type hinting
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from sse_starlette.sse import EventSourceResponse
+from prometheus_client import Histogram
+from prometheus_fastapi_instrumentator import Instrumentator
 from pydantic import BaseModel, Field
+import numpy as np
+import orjson
 import pandas as pd
-from sklearn.manifold import TSNE
+import torch
+from diskcache import Cache
+from openTSNE import TSNE
 
 from langchain.chains import create_history_aware_retriever, create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, UnstructuredWordDocumentLoader
+from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.retrievers import ParentDocumentRetriever
+from langchain.storage import LocalFileStore, create_kv_docstore
 from langchain_chroma import Chroma
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun
+from langchain_core.documents import Document
 
 
 
@@ -37,45 +58,488 @@ class QueryRequest(BaseModel):
 # Define persistent paths
 UPLOAD_DIRECTORY = "uploads"
 CHROMA_DB_PATH = "chroma_db"
+EMBEDDING_CACHE_PATH = "embedding_cache"
+PARENT_STORE_PATH = "parent_docstore"
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_WORKERS = 4
+INGEST_QUEUE_SIZE = 2
+# MiniLM emits 384-dim vectors; only the first EMBEDDING_DIMENSIONS are kept (then re-normalized)
+# to shrink vector search and t-SNE work. Each size gets its own Chroma collection.
+EMBEDDING_DIMENSIONS = 128
+# Retrieval knobs, overridable through the environment
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "10"))
+RAG_HNSW_EF = int(os.getenv("RAG_HNSW_EF", "64"))
+RAG_CLIENT_TIMEOUT_MS = int(os.getenv("RAG_CLIENT_TIMEOUT_MS", "60000"))
+QUERY_BATCH_SIZE = 16
+QUERY_BATCH_WAIT_SECONDS = 0.05
 
 # Create directories if they don't exist
 os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
 os.makedirs(CHROMA_DB_PATH, exist_ok=True)
+os.makedirs(EMBEDDING_CACHE_PATH, exist_ok=True)
+os.makedirs(PARENT_STORE_PATH, exist_ok=True)
+
+
+# --- Latency Instrumentation ---
+
+logger = logging.getLogger("rag_app")
+logger.setLevel(logging.INFO)
+if not logger.handlers:
+    logger.addHandler(logging.StreamHandler())
+
+CHAT_PHASE_SECONDS = Histogram(
+    "rag_chat_phase_seconds",
+    "Time spent in each phase of a /chat/ request.",
+    ["model_name", "phase"],
+)
+
+# Models offered by the frontend; any other model name is labeled "other" to keep metric cardinality bounded
+KNOWN_CHAT_MODELS = {"gpt-4o", "gpt-4-turbo", "gpt-3.5-turbo"}
+
+# Timing keys recorded per /chat/ request -> histogram phase label
+CHAT_PHASES = {
+    "t_embed_ms": "embed",
+    "t_search_ms": "search",
+    "t_llm_ms": "llm",
+    "t_format_ms": "format",
+    "total_ms": "total",
+}
+
+# Per-request phase timings (in ms). The retriever runs inside the chain, so it records its
+# phases into the dict the /chat/ handler placed here.
+chat_timings: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("chat_timings", default=None)
+
+
+def elapsed_ms(start_ns: int) -> float:
+    return (time.perf_counter_ns() - start_ns) / 1e6
+
+
+# --- Cached Embeddings ---
+
+class CachedHuggingFaceEmbeddings(HuggingFaceEmbeddings):
+    """
+    HuggingFace embeddings backed by a content-addressed disk cache.
+    Texts that were embedded before (by the same model) skip the forward pass.
+    Vectors can optionally be truncated to their first `truncate_dim` dimensions and re-normalized.
+    """
+    cache_path: str
+    truncate_dim: Optional[int] = None
+    _cache: Any = None
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._cache = Cache(self.cache_path)
+
+    def _cache_key(self, text: str) -> bytes:
+        # Key on the model and output size as well as the text so config changes never return stale vectors.
+        model_id = f"{self.model_name}:{self.truncate_dim or 'full'}"
+        return hashlib.blake2b(f"{model_id}\0{text}".encode("utf-8"), digest_size=32).digest()
+
+    def _postprocess(self, embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        if self.truncate_dim:
+            vector = vector[:self.truncate_dim]
+            norm = np.linalg.norm(vector)
+            if norm > 0:
+                vector = vector / norm
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._cache_key(text) for text in texts]
+        results = [self._cache.get(key) for key in keys]
+
+        # Only run the encoder on cache misses, then splice them back in their original order.
+        misses = [i for i, result in enumerate(results) if result is None]
+        if misses:
+            new_embeddings = super().embed_documents([texts[i] for i in misses])
+            for i, embedding in zip(misses, new_embeddings):
+                vector = self._postprocess(embedding)
+                self._cache.set(keys[i], vector)
+                results[i] = vector
+
+        return [result.tolist() for result in results]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._cache_key(text)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached.tolist()
+
+        vector = self._postprocess(super().embed_query(text))
+        self._cache.set(key, vector)
+        return vector.tolist()
+
+
+# --- Query Batching ---
+
+class QueryBatcher:
+    """
+    Coalesces concurrent retrieval queries into a single embedding call and a single Chroma query.
+    A batch is flushed when it reaches `max_batch_size` or `max_wait_seconds` after its first query.
+    """
+
+    def __init__(self, embeddings, vector_store, n_results: int, max_batch_size: int, max_wait_seconds: float):
+        self.embeddings = embeddings
+        self.vector_store = vector_store
+        self.n_results = n_results
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def search(self, query: str) -> Tuple[List[dict], dict]:
+        """Returns the metadatas of the nearest stored chunks for a single query, and the batch's timings."""
+        # The queue and worker are created lazily so they bind to the server's event loop
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((query, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait_seconds
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            queries = [query for query, _ in batch]
+            try:
+                results = await anyio.to_thread.run_sync(self._search_batch, queries)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            metadatas, timings = results
+            for (_, future), result in zip(batch, metadatas):
+                if not future.done():
+                    future.set_result((result, timings))
+
+    def _search_batch(self, queries: List[str]) -> Tuple[List[List[dict]], dict]:
+        start = time.perf_counter_ns()
+        query_embeddings = self.embeddings.embed_documents(queries)
+        t_embed_ms = elapsed_ms(start)
+
+        start = time.perf_counter_ns()
+        results = self.vector_store._collection.query(
+            query_embeddings=query_embeddings,
+            n_results=self.n_results,
+            include=["metadatas"],
+        )
+        t_search_ms = elapsed_ms(start)
+
+        return results["metadatas"], {"t_embed_ms": t_embed_ms, "t_search_ms": t_search_ms, "batch_size": len(queries)}
+
+
+class BatchedParentDocumentRetriever(ParentDocumentRetriever):
+    """ParentDocumentRetriever whose async path looks up child chunks through a shared QueryBatcher."""
+    batcher: Any
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        child_metadatas, timings = await self.batcher.search(query)
+        start = time.perf_counter_ns()
+
+        # Keep the parent ids in ranking order, without duplicates
+        parent_ids = []
+        for metadata in child_metadatas:
+            parent_id = (metadata or {}).get(self.id_key)
+            if parent_id and parent_id not in parent_ids:
+                parent_ids.append(parent_id)
+
+        parents = await self.docstore.amget(parent_ids)
+
+        request_timings = chat_timings.get()
+        if request_timings is not None:
+            # The parent lookup is part of the search phase
+            request_timings.update(timings, t_search_ms=timings["t_search_ms"] + elapsed_ms(start))
+        return [parent for parent in parents if parent is not None]
+
+
+# --- Ingest Pipeline ---
+
+_PIPELINE_DONE = object()
+
+
+class IngestPipeline:
+    """
+    Ingests documents as four overlapping stages (load -> split -> embed -> add) connected by
+    bounded asyncio queues, so a page can be loaded and split while earlier chunks are still embedding.
+    """
+
+    def __init__(self, embeddings, vector_store, docstore, parent_splitter, child_splitter, id_key: str,
+                 executor: ThreadPoolExecutor, batch_size: int, queue_size: int, max_embedding_batches: int):
+        self.embeddings = embeddings
+        self.vector_store = vector_store
+        self.docstore = docstore
+        self.parent_splitter = parent_splitter
+        self.child_splitter = child_splitter
+        self.id_key = id_key
+        self.executor = executor
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.max_embedding_batches = max_embedding_batches
+
+    async def run(self, documents: Iterator[Document]) -> int:
+        """Runs every stage over the documents and returns the number of chunks stored."""
+        split_queue = asyncio.Queue(maxsize=self.queue_size)
+        embed_queue = asyncio.Queue(maxsize=self.queue_size)
+        # Bounds how many embedding batches are in flight on the executor at once
+        add_queue = asyncio.Queue(maxsize=self.max_embedding_batches)
+
+        # Everything _add writes is recorded here so a failed ingest can be rolled back
+        written = {"child_ids": [], "parent_ids": []}
+
+        tasks = [
+            asyncio.create_task(self._load(documents, split_queue)),
+            asyncio.create_task(self._split(split_queue, embed_queue)),
+            asyncio.create_task(self._embed(embed_queue, add_queue)),
+            asyncio.create_task(self._add(add_queue, written)),
+        ]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            # Wait for in-flight writes to finish before removing what was stored
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await anyio.to_thread.run_sync(self._rollback, written)
+            raise
+        return results[-1]
+
+    def _rollback(self, written: dict):
+        if written["child_ids"]:
+            self.vector_store._collection.delete(ids=written["child_ids"])
+        if written["parent_ids"]:
+            self.docstore.mdelete(written["parent_ids"])
+
+    async def _load(self, documents: Iterator[Document], out_queue: asyncio.Queue):
+        # Loaders may read lazily (e.g. one PDF page at a time), so each step runs in a thread
+        while (document := await anyio.to_thread.run_sync(next, documents, None)) is not None:
+            await out_queue.put(document)
+        await out_queue.put(_PIPELINE_DONE)
+
+    async def _split(self, in_queue: asyncio.Queue, out_queue: asyncio.Queue):
+        # Emits (child chunks, parents) batches; a parent is always emitted no later than its children
+        children, parents = [], []
+        while (document := await in_queue.get()) is not _PIPELINE_DONE:
+            # A .txt or .docx file arrives as one large document, so splitting runs in a thread
+            for parent_id, parent, parent_children in await anyio.to_thread.run_sync(self._split_document, document):
+                parents.append((parent_id, parent))
+                for child in parent_children:
+                    children.append(child)
+                    if len(children) == self.batch_size:
+                        await out_queue.put((children, parents))
+                        children, parents = [], []
+        if children or parents:
+            await out_queue.put((children, parents))
+        await out_queue.put(_PIPELINE_DONE)
+
+    def _split_document(self, document: Document) -> List[Tuple[str, Document, List[Document]]]:
+        """Splits a document into parents, each with its child chunks pointing back to it."""
+        split = []
+        for parent in self.parent_splitter.split_documents([document]):
+            parent_id = str(uuid.uuid4())
+            children = self.child_splitter.split_documents([parent])
+            for child in children:
+                child.metadata[self.id_key] = parent_id
+            split.append((parent_id, parent, children))
+        return split
+
+    async def _embed(self, in_queue: asyncio.Queue, out_queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while (batch := await in_queue.get()) is not _PIPELINE_DONE:
+            children, parents = batch
+            texts = [child.page_content for child in children]
+            future = loop.run_in_executor(self.executor, self.embeddings.embed_documents, texts)
+            await out_queue.put((children, parents, future))
+        await out_queue.put(_PIPELINE_DONE)
+
+    async def _add(self, in_queue: asyncio.Queue, written: dict) -> int:
+        stored = 0
+        while (batch := await in_queue.get()) is not _PIPELINE_DONE:
+            children, parents, future = batch
+            embeddings = await future
+            if parents:
+                written["parent_ids"].extend(parent_id for parent_id, _ in parents)
+                await anyio.to_thread.run_sync(self.docstore.mset, parents)
+            if children:
+                child_ids = [str(uuid.uuid4()) for _ in children]
+                written["child_ids"].extend(child_ids)
+                await anyio.to_thread.run_sync(self._add_children, child_ids, children, embeddings)
+            stored += len(children)
+        return stored
+
+    def _add_children(self, child_ids: List[str], children: List[Document], embeddings: List[List[float]]):
+        self.vector_store._collection.add(
+            ids=child_ids,
+            embeddings=embeddings,
+            documents=[child.page_content for child in children],
+            metadatas=[child.metadata for child in children],
+        )
 
 
 # --- RAG Components Initialization ---
 # (This happens once when the app starts)
 
 # 1. Embedding Model
-print("Loading HuggingFace Embeddings model...")
-embedding_function = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+# Run on the GPU in half precision when one is available, otherwise fall back to CPU/FP32.
+if torch.cuda.is_available():
+    embedding_device = "cuda"
+    embedding_model_kwargs = {"device": "cuda", "model_kwargs": {"torch_dtype": torch.float16}}
+else:
+    embedding_device = "cpu"
+    embedding_model_kwargs = {"device": "cpu"}
+
+print(f"Loading HuggingFace Embeddings model on {embedding_device}...")
+embedding_function = CachedHuggingFaceEmbeddings(
+    model_name="all-MiniLM-L6-v2",
+    cache_path=EMBEDDING_CACHE_PATH,
+    truncate_dim=EMBEDDING_DIMENSIONS,
+    model_kwargs=embedding_model_kwargs,
+    encode_kwargs={"batch_size": 128, "normalize_embeddings": True, "convert_to_numpy": True}
+)
+# Warm up the model so the first real request doesn't pay for CUDA context setup.
+# This bypasses the embedding cache, which would otherwise skip the forward pass after the first run.
+HuggingFaceEmbeddings.embed_query(embedding_function, "warmup")
 print("Model loaded.")
 
+# Bounded pool used to encode several batches at once, so tokenization on one thread
+# overlaps with the model forward pass of another.
+embedding_executor = ThreadPoolExecutor(max_workers=EMBEDDING_WORKERS)
+
+
 # 2. ChromaDB Vector Store
 vector_store = Chroma(
+    collection_name=f"documents_{EMBEDDING_DIMENSIONS}d",
     persist_directory=CHROMA_DB_PATH,
-    embedding_function=embedding_function
+    embedding_function=embedding_function,
+    # HNSW index settings; these only take effect when the collection is first created
+    collection_metadata={
+        "hnsw:space": "cosine",
+        "hnsw:M": 32,
+        "hnsw:construction_ef": 200,
+        "hnsw:search_ef": RAG_HNSW_EF,
+    },
 )
 
 # 3. Retriever
+# Small child chunks are embedded for precise matching, but the LLM is given the larger
+# parent chunk each match belongs to. Parents are kept on disk next to the vector store.
+parent_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
+child_splitter = RecursiveCharacterTextSplitter(chunk_size=200, chunk_overlap=20)
+parent_docstore = create_kv_docstore(LocalFileStore(PARENT_STORE_PATH))
+
+# Concurrent /chat/ requests share embedding and vector search calls through this batcher.
+query_batcher = QueryBatcher(
+    embedding_function,
+    vector_store,
+    n_results=RAG_TOP_K,
+    max_batch_size=QUERY_BATCH_SIZE,
+    max_wait_seconds=QUERY_BATCH_WAIT_SECONDS,
+)
+
 # This object is responsible for fetching relevant documents from the vector store.
-retriever = vector_store.as_retriever(search_kwargs={"k": 5})
+retriever = BatchedParentDocumentRetriever(
+    vectorstore=vector_store,
+    docstore=parent_docstore,
+    child_splitter=child_splitter,
+    parent_splitter=parent_splitter,
+    search_kwargs={"k": RAG_TOP_K},
+    batcher=query_batcher,
+)
+
+# Uploads are ingested through this pipeline; its embed stage runs on the embedding pool.
+ingest_pipeline = IngestPipeline(
+    embedding_function,
+    vector_store,
+    parent_docstore,
+    parent_splitter,
+    child_splitter,
+    id_key=retriever.id_key,
+    executor=embedding_executor,
+    batch_size=EMBEDDING_BATCH_SIZE,
+    queue_size=INGEST_QUEUE_SIZE,
+    max_embedding_batches=EMBEDDING_WORKERS,
+)
+
+# 4. Prompt Templates
+# Built once here; the per-model chains below only combine them with an LLM.
+
+# Condenses the user's question and the chat history into a single, standalone question.
+contextualize_q_system_prompt = """Given a chat history and the latest user question \
+which might reference context in the chat history, formulate a standalone question \
+which can be understood without the chat history. Do NOT answer the question, \
+just reformulate it if needed and otherwise return it as is."""
+contextualize_q_prompt = ChatPromptTemplate.from_messages([
+    ("system", contextualize_q_system_prompt),
+    MessagesPlaceholder("chat_history"),
+    ("human", "{input}"),
+])
+
+# Answers the original question from the retrieved documents.
+qa_system_prompt = """You are an assistant for question-answering tasks. \
+Use the following pieces of retrieved context to answer the question. \
+If you don't know the answer, just say that you don't know. \
+Your answer should be detailed and well-formatted. Use Markdown for lists, bullet points, and bolding to improve readability.
+
+{context}"""
+qa_prompt = ChatPromptTemplate.from_messages([
+    ("system", qa_system_prompt),
+    MessagesPlaceholder("chat_history"),
+    ("human", "{input}"),
+])
 
-# 4. Prompt Template
-# This template will be used to structure the input to the LLM.
-prompt_template = """
-You are a helpful assistant.
-Use the following pieces of retrieved context to answer the question.
-Your answer should be detailed and well-formatted.
-Use Markdown for lists, bullet points, and bolding to improve readability.
-If you don't know the answer, just say that you don't know.
 
-Question: {question}
-Context: {context}
+# 5. t-SNE result cache for the visualization endpoint
+# Holds the ids hash the last projection was computed for, and its response data
+tsne_cache: dict = {}
 
-Answer:
-"""
-prompt = PromptTemplate.from_template(prompt_template)
+# 6. Known document sources for the list endpoint
+# Scanned from ChromaDB once at startup and kept up to date by /upload/, so listing needs no DB call.
+existing_sources = vector_store.get(include=["metadatas"])
+known_sources: set[str] = {
+    metadata["source"] for metadata in existing_sources.get("metadatas") or [] if metadata and "source" in metadata
+}
+known_sources_lock = asyncio.Lock()
+
+
+# --- RAG Chain Factories ---
+# LLM clients and chains are built once per model and reused across requests.
+
+@lru_cache(maxsize=8)
+def get_llm(model_name: str) -> ChatOpenAI:
+    """Returns a cached chat model client for the given model name."""
+    return ChatOpenAI(model=model_name, temperature=0, timeout=RAG_CLIENT_TIMEOUT_MS / 1000)
+
+
+@lru_cache(maxsize=8)
+def get_rag_chain(model_name: str):
+    """Builds the conversational RAG chain for the given model and caches it."""
+    # 1. Get the LLM
+    llm = get_llm(model_name)
+
+    # 2. Create a history-aware retriever chain
+    history_aware_retriever = create_history_aware_retriever(llm, retriever, contextualize_q_prompt)
+
+    # 3. Create the main question-answering chain
+    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
+
+    # 4. Combine them into the final RAG chain
+    return create_retrieval_chain(history_aware_retriever, question_answer_chain)
 
 
 # --- FastAPI App Initialization ---
@@ -84,8 +548,12 @@ app = FastAPI(
     title="RAG App API",
     description="API for document uploads and chat with a RAG pipeline.",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
+# Request count/latency metrics for every endpoint, served at /metrics
+Instrumentator().instrument(app).expose(app)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],
@@ -106,74 +574,97 @@ async def read_root():
 @app.post("/chat/", tags=["Chat"])
 async def chat_with_document(request: QueryRequest):
     """
-    Accepts a question and model name, returns an answer from the RAG pipeline.
+    Accepts a question and model name, streams the answer from the RAG pipeline as Server-Sent Events.
+    Emits `token` events while the answer is generated, then a final `sources` event.
     """
+    request_start = time.perf_counter_ns()
     try:
         print(f"Received chat request with model: {request.model_name}")
         
-        # --- COMPLETELY NEW RAG CHAIN LOGIC FOR CONVERSATION ---
-
-        # 1. Instantiate the LLM
-        llm = ChatOpenAI(model=request.model_name, temperature=0)
-
-        # 2. Create a history-aware retriever chain
-        # This first chain condenses the user's question and the chat history into a single, standalone question.
-        contextualize_q_system_prompt = """Given a chat history and the latest user question \
-        which might reference context in the chat history, formulate a standalone question \
-        which can be understood without the chat history. Do NOT answer the question, \
-        just reformulate it if needed and otherwise return it as is."""
-        contextualize_q_prompt = ChatPromptTemplate.from_messages([
-            ("system", contextualize_q_system_prompt),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}"),
-        ])
-        history_aware_retriever = create_history_aware_retriever(llm, retriever, contextualize_q_prompt)
-
-        # 3. Create the main question-answering chain
-        # This chain takes the original question and the retrieved documents and generates an answer.
-        qa_system_prompt = """You are an assistant for question-answering tasks. \
-        Use the following pieces of retrieved context to answer the question. \
-        If you don't know the answer, just say that you don't know. \
-        Your answer should be detailed and well-formatted. Use Markdown for lists, bullet points, and bolding to improve readability.
-
-        {context}"""
-        qa_prompt = ChatPromptTemplate.from_messages([
-            ("system", qa_system_prompt),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}"),
-        ])
-        question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
-
-        # 4. Combine them into the final RAG chain
-        rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
-
-        # 5. Format the chat history from the request into the format LangChain expects
+        # 1. Get the (cached) RAG chain for the requested model
+        rag_chain = get_rag_chain(request.model_name)
+
+        # 2. Format the chat history from the request into the format LangChain expects
+        format_start = time.perf_counter_ns()
         formatted_chat_history = []
         for msg in request.chat_history:
             if msg.sender == 'user':
                 formatted_chat_history.append(HumanMessage(content=msg.text))
             elif msg.sender == 'ai':
                 formatted_chat_history.append(AIMessage(content=msg.text))
+        t_format_ms = elapsed_ms(format_start)
 
-        # 6. Invoke the chain with the new question and the formatted history
-        result = rag_chain.invoke({
-            "chat_history": formatted_chat_history,
-            "input": request.question
-        })
-
-        # 7. Format sources for the response
-        sources = []
-        for doc in result["context"]:
-            sources.append({
-                "source": doc.metadata.get("source", "Unknown"),
-                "page_content": doc.page_content
-            })
-
-        return {"answer": result["answer"], "sources": sources}
-            
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred in the chat endpoint: {e}")
 
+    async def event_stream():
+        timings = {"t_format_ms": t_format_ms}
+        chat_timings.set(timings)
+        sources = []
+        try:
+            # 3. Stream the chain with the new question and the formatted history
+            llm_start = None
+            async for chunk in rag_chain.astream({
+                "chat_history": formatted_chat_history,
+                "input": request.question
+            }):
+                # 4. Format sources for the response once the retrieved context is available
+                if "context" in chunk:
+                    format_start = time.perf_counter_ns()
+                    sources = [
+                        {"source": doc.metadata.get("source", "Unknown"), "page_content": doc.page_content}
+                        for doc in chunk["context"]
+                    ]
+                    timings["t_format_ms"] += elapsed_ms(format_start)
+                    timings["t_retrieval_ms"] = elapsed_ms(request_start)
+                    llm_start = time.perf_counter_ns()
+                if chunk.get("answer"):
+                    if "t_first_token_ms" not in timings:
+                        timings["t_first_token_ms"] = elapsed_ms(request_start)
+                    # JSON-encode tokens so newlines in the answer survive SSE framing
+                    yield {"event": "token", "data": json.dumps(chunk["answer"])}
+
+            if llm_start is not None:
+                timings["t_llm_ms"] = elapsed_ms(llm_start)
+            yield {"event": "sources", "data": orjson.dumps(sources).decode()}
+
+        except Exception as e:
+            # Headers are already sent at this point, so errors are reported in-stream
+            timings["error"] = str(e)
+            yield {"event": "error", "data": json.dumps(f"An error occurred in the chat endpoint: {e}")}
+
+        finally:
+            timings["total_ms"] = elapsed_ms(request_start)
+            log_chat_timings(request.model_name, timings)
+
+    return EventSourceResponse(event_stream(), sep="\n")
+
+
+def log_chat_timings(model_name: str, timings: dict):
+    """Emits a /chat/ request's phase timings as a structured log line and as Prometheus histograms."""
+    logger.info(json.dumps({"event": "chat_latency", "model_name": model_name, **timings}))
+    model_label = model_name if model_name in KNOWN_CHAT_MODELS else "other"
+    for key, phase in CHAT_PHASES.items():
+        if key in timings:
+            CHAT_PHASE_SECONDS.labels(model_name=model_label, phase=phase).observe(timings[key] / 1000)
+
+
+def get_loader(file_path: str, file_extension: str):
+    """Selects a document loader based on the file extension. `.txt` uploads are read in memory instead."""
+    if file_extension == ".pdf":
+        return PyPDFLoader(file_path)
+    elif file_extension == ".docx":
+        return Docx2txtLoader(file_path)
+    else:
+        raise HTTPException(status_code=400, detail=f"Unsupported file type: {file_extension}")
+
+
+def with_source(documents: Iterator[Document], source: str) -> Iterator[Document]:
+    """Sets the `source` metadata of loaded documents, replacing the temporary path the loader saw."""
+    for document in documents:
+        document.metadata["source"] = source
+        yield document
+
 
 @app.post("/upload/", tags=["Documents"])
 async def upload_document(file: UploadFile = File(...)):
@@ -182,48 +673,111 @@ async def upload_document(file: UploadFile = File(...)):
     """
     file_path = os.path.join(UPLOAD_DIRECTORY, file.filename)
     file_extension = os.path.splitext(file.filename)[1].lower()
+    # Each upload is written to its own path so concurrent uploads of the same filename don't collide;
+    # file_path is still what gets recorded as the chunks' source.
+    temp_path = os.path.join(UPLOAD_DIRECTORY, f"{uuid.uuid4().hex}{file_extension}")
 
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        # --- Select loader based on file extension ---
-        if file_extension == ".pdf":
-            loader = PyPDFLoader(file_path)
-        elif file_extension == ".docx":
-            loader = UnstructuredWordDocumentLoader(file_path)
-        elif file_extension == ".txt":
-            loader = TextLoader(file_path)
+        if file_extension == ".txt":
+            # Plain text needs no loader, so skip the round trip through disk
+            content = await file.read()
+            documents = iter([Document(page_content=content.decode("utf-8"), metadata={"source": file_path})])
         else:
-            raise HTTPException(status_code=400, detail=f"Unsupported file type: {file_extension}")
+            # Stream the upload to disk in large blocks without blocking the event loop
+            async with await anyio.open_file(temp_path, "wb") as buffer:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    await buffer.write(chunk)
 
-        print(f"Processing {file.filename} with {loader.__class__.__name__}...")
-        documents = loader.load()
+            loader = get_loader(temp_path, file_extension)
+            print(f"Processing {file.filename} with {loader.__class__.__name__}...")
+            documents = with_source(loader.lazy_load(), file_path)
 
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-        chunks = text_splitter.split_documents(documents)
-        
-        if not chunks:
+        # The heavy stages run in worker threads, so other requests keep being served meanwhile
+        chunks_count = await ingest_pipeline.run(documents)
+
+        if not chunks_count:
             raise HTTPException(status_code=500, detail="Could not extract text from the PDF.")
+        print(f"Successfully embedded and stored {chunks_count} document chunks.")
+
+        # Record the source under the same path the loaders put in the chunk metadata
+        async with known_sources_lock:
+            known_sources.add(file_path)
 
-        print(f"Splitting document into {len(chunks)} chunks.")
-        vector_store.add_documents(chunks)
-        print(f"Successfully embedded and stored document chunks.")
-        
         return {
             "filename": file.filename,
             "detail": f"Successfully processed and stored in vector DB.",
-            "chunks_count": len(chunks)
+            "chunks_count": chunks_count
         }
 
     except Exception as e:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
         raise HTTPException(status_code=500, detail=f"An error occurred: {e}")
     finally:
-        file.file.close()
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        await file.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def _vis_point(x: float, y: float, text: str, metadata: dict) -> dict:
+    return {"x": x, "y": y, "text": text, "source": metadata.get("source", "Unknown source")}
+
+
+def build_visualization() -> List[dict]:
+    """
+    Fetches all embeddings and projects them to 2D with t-SNE, reusing the cached result when possible.
+    This is CPU-bound and blocking, so it is run in a worker thread.
+    """
+    # Chunks can be removed again (e.g. a failed upload is rolled back), so the cached result is
+    # only reused when the exact set of chunk ids matches. Fetching ids alone is cheap.
+    chunk_ids = vector_store.get(include=[])["ids"]
+    if not chunk_ids:
+        raise HTTPException(status_code=404, detail="No documents found to visualize.")
+    if len(chunk_ids) < 3:
+        raise HTTPException(status_code=400, detail="Not enough documents (need at least 3) to create a meaningful visualization.")
+    if tsne_cache.get("ids_hash") == hash(tuple(sorted(chunk_ids))):
+        return tsne_cache["vis_data"]
+
+    # 1. Fetch all data from ChromaDB
+    # --- FIX 1: We need to include "documents" to get the text content ---
+    existing_data = vector_store.get(include=["metadatas", "embeddings", "documents"])
+    
+    if not existing_data or not existing_data.get("ids"):
+        raise HTTPException(status_code=404, detail="No documents found to visualize.")
+
+    embeddings = existing_data["embeddings"]
+    metadatas = existing_data["metadatas"]
+    documents = existing_data["documents"] # <-- Grab the documents list
+
+    # The projection only changes when the set of stored chunks changes
+    ids_hash = hash(tuple(sorted(existing_data["ids"])))
+
+    # One contiguous float32 buffer, L2-normalized so euclidean distance ranks like cosine
+    X = np.ascontiguousarray(np.asarray(embeddings, dtype=np.float32))
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    X /= np.where(norms > 0, norms, 1.0)
+
+    print(f"Running t-SNE on {len(embeddings)} vectors...")
+    tsne = TSNE(
+        n_components=2,
+        perplexity=min(30, len(embeddings) - 1),
+        metric="euclidean",
+        initialization="pca",
+        n_jobs=-1,
+        negative_gradient_method="fft",
+        random_state=42,
+    )
+    tsne_results = np.asarray(tsne.fit(X))
+    print("t-SNE complete.")
+
+    # Convert the coordinate columns in one go instead of indexing the array per point
+    xs = tsne_results[:, 0].astype(float).tolist()
+    ys = tsne_results[:, 1].astype(float).tolist()
+    # --- FIX 2: Get the text from the 'documents' list ---
+    vis_data = list(map(_vis_point, xs, ys, documents, metadatas))
+
+    tsne_cache.update({"ids_hash": ids_hash, "vis_data": vis_data})
+    return vis_data
+
 
 @app.get("/documents/visualize/", tags=["Documents"])
 async def visualize_documents():
@@ -232,36 +786,8 @@ async def visualize_documents():
     and returns 2D coordinates for visualization.
     """
     try:
-        # 1. Fetch all data from ChromaDB
-        # --- FIX 1: We need to include "documents" to get the text content ---
-        existing_data = vector_store.get(include=["metadatas", "embeddings", "documents"])
-        
-        if not existing_data or not existing_data.get("ids"):
-             raise HTTPException(status_code=404, detail="No documents found to visualize.")
-
-        embeddings = existing_data["embeddings"]
-        metadatas = existing_data["metadatas"]
-        documents = existing_data["documents"] # <-- Grab the documents list
-
-        if len(embeddings) < 3:
-            raise HTTPException(status_code=400, detail="Not enough documents (need at least 3) to create a meaningful visualization.")
-
-        print(f"Running t-SNE on {len(embeddings)} vectors...")
-        tsne = TSNE(n_components=2, perplexity=min(30, len(embeddings) - 1), random_state=42)
-        tsne_results = tsne.fit_transform(embeddings)
-        print("t-SNE complete.")
-
-        vis_data = []
-        for i, metadata in enumerate(metadatas):
-            vis_data.append({
-                "x": float(tsne_results[i, 0]),
-                "y": float(tsne_results[i, 1]),
-                # --- FIX 2: Get the text from the 'documents' list ---
-                "text": documents[i], 
-                "source": metadata.get("source", "Unknown source")
-            })
-
-        return vis_data
+        # Run the fetch and projection in a thread so streamed chats keep being served
+        return await anyio.to_thread.run_sync(build_visualization)
 
     except HTTPException as http_exc:
         raise http_exc
@@ -271,18 +797,11 @@ async def visualize_documents():
 @app.get("/documents/list/", tags=["Documents"])
 async def list_documents():
     """
-    Fetches metadata for all documents and returns a list of unique source filenames.
+    Returns a sorted list of the unique source filenames stored in the vector DB.
     """
     try:
-        existing_data = vector_store.get(include=["metadatas"])
-        
-        if not existing_data or not existing_data.get("ids"):
-             return []
-
-        # Use a set to automatically handle uniqueness of source filenames
-        unique_sources = set(metadata['source'] for metadata in existing_data['metadatas'])
-        
-        return sorted(list(unique_sources)) # Return a sorted list
+        async with known_sources_lock:
+            return sorted(known_sources)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred while listing documents: {e}")
\ No newline at end of file
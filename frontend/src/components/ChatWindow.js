@@ -1,6 +1,5 @@
 // src/components/ChatWindow.js
 import React, { useState, useEffect, useRef } from 'react';
-import axios from 'axios';
 import ReactMarkdown from 'react-markdown';
 
 function Source({ source, index }) {
@@ -12,6 +11,20 @@ function Source({ source, index }) {
   );
 }
 
+// Parses one Server-Sent Event frame into its event name and data payload
+function parseServerSentEvent(frame) {
+  let event = 'message';
+  const dataLines = [];
+  for (const line of frame.split('\n')) {
+    if (line.startsWith('event:')) {
+      event = line.slice(6).trim();
+    } else if (line.startsWith('data:')) {
+      dataLines.push(line.slice(5).replace(/^ /, ''));
+    }
+  }
+  return { event, data: dataLines.join('\n') };
+}
+
 // The component now receives messages and setMessages as props
 function ChatWindow({ selectedModel, messages, setMessages }) {
   const [input, setInput] = useState('');
@@ -39,19 +52,64 @@ function ChatWindow({ selectedModel, messages, setMessages }) {
 
     const chatHistoryForAPI = messages.map(msg => ({ sender: msg.sender, text: msg.text }));
 
+    const aiMessageId = Date.now() + 1;
+    let aiMessageAdded = false;
+    let answer = '';
+
+    // Creates the AI message on the first streamed event, then updates it in place
+    const updateAiMessage = (fields) => {
+      if (!aiMessageAdded) {
+        aiMessageAdded = true;
+        setMessages(prev => [...prev, { sender: 'ai', text: '', sources: [], id: aiMessageId, ...fields }]);
+      } else {
+        setMessages(prev => prev.map(msg => (msg.id === aiMessageId ? { ...msg, ...fields } : msg)));
+      }
+    };
+
     try {
-      const response = await axios.post('http://localhost:8000/chat/', {
-        question: input,
-        model_name: selectedModel,
-        chat_history: chatHistoryForAPI
+      // The answer is streamed back as Server-Sent Events, so use fetch to read the body incrementally
+      const response = await fetch('http://localhost:8000/chat/', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          question: input,
+          model_name: selectedModel,
+          chat_history: chatHistoryForAPI
+        })
       });
-      const aiMessage = { sender: 'ai', text: response.data.answer, sources: response.data.sources, id: Date.now() };
-       // Also using the setMessages function from props here
-      setMessages(prev => [...prev, aiMessage]);
+      if (!response.ok) {
+        throw new Error(`Chat request failed with status ${response.status}`);
+      }
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Events are separated by a blank line
+        let separatorIndex;
+        while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+          const { event, data } = parseServerSentEvent(buffer.slice(0, separatorIndex));
+          buffer = buffer.slice(separatorIndex + 2);
+          if (!data) continue;
+
+          if (event === 'token') {
+            answer += JSON.parse(data);
+            updateAiMessage({ text: answer });
+          } else if (event === 'sources') {
+            updateAiMessage({ sources: JSON.parse(data) });
+          } else if (event === 'error') {
+            throw new Error(JSON.parse(data));
+          }
+        }
+      }
     } catch (error) {
       console.error('Error sending message:', error);
-      const errorMessage = { sender: 'ai', text: 'Sorry, I ran into an error. Please try again.', id: Date.now() };
-      setMessages(prev => [...prev, errorMessage]);
+      updateAiMessage({ text: 'Sorry, I ran into an error. Please try again.' });
     } finally {
       setIsLoading(false);
     }
@@ -87,7 +145,7 @@ function ChatWindow({ selectedModel, messages, setMessages }) {
             )}
           </div>
         ))}
-        {isLoading && <div className="flex justify-start"><div className="bg-gray-700 p-4 rounded-lg">Thinking...</div></div>}
+        {isLoading && messages[messages.length - 1]?.sender !== 'ai' && <div className="flex justify-start"><div className="bg-gray-700 p-4 rounded-lg">Thinking...</div></div>}
       </div>
       <div className="p-4 bg-gray-800 border-t border-gray-700">
         <form className="flex gap-4" onSubmit={handleSendMessage}>